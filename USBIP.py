@@ -1,13 +1,58 @@
 import socket
 import struct
+import threading
 from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+
+from usbip_trace import STAGE_COMPLETED, STAGE_DECODED, STAGE_DISPATCHED, tracer
 
 
 USBIP_DIR_OUT = 0
 USBIP_DIR_IN = 1
 
+# Verbose per-URB logging with hex dumps of every payload, see set_debug()
+debug = False
+
+# enum usb_device_speed, as reported in OP_REP_DEVLIST / OP_REP_IMPORT
+USB_SPEED_FULL = 2
+USB_SPEED_HIGH = 3
+USB_SPEED_SUPER = 5
+
+# Descriptor values that have to agree with the speed reported to the host
+USB_SPEED_PROFILES = {
+    'full': {
+        'speed': USB_SPEED_FULL,
+        'bcdUSB': 0x0110,
+        'bMaxPacketSize0': 0x40,
+        'bulk_max_packet_size': 0x40,
+        'device_qualifier': False,
+        'bos': False,
+    },
+    'high': {
+        'speed': USB_SPEED_HIGH,
+        'bcdUSB': 0x0200,
+        'bMaxPacketSize0': 0x40,
+        'bulk_max_packet_size': 0x200,
+        'device_qualifier': True,
+        'bos': False,
+    },
+    'super': {
+        'speed': USB_SPEED_SUPER,
+        'bcdUSB': 0x0300,
+        'bMaxPacketSize0': 0x09,  # 2^9 = 512 bytes
+        'bulk_max_packet_size': 0x400,
+        'device_qualifier': False,  # must stall while operating at SuperSpeed
+        'bos': True,
+    },
+}
+
 
 class BaseStructure(ABC):
+    __slots__ = ()
+
+    # Compiled struct.Struct and field names per class, see layout()
+    _layouts_ = {}
+
     def __init__(self, **kwargs):
         self.init_from_dict(**kwargs)
         for field in self._fields_:
@@ -19,8 +64,15 @@ class BaseStructure(ABC):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    def layout(self):
+        layout = BaseStructure._layouts_.get(type(self))
+        if layout is None:
+            layout = (struct.Struct(self.format()), tuple(field[0] for field in self._fields_))
+            BaseStructure._layouts_[type(self)] = layout
+        return layout
+
     def size(self):
-        return struct.calcsize(self.format())
+        return self.layout()[0].size
 
     def format(self):
         pack_format = self._byte_order_
@@ -38,15 +90,12 @@ class BaseStructure(ABC):
                 values.append(getattr(self, field[0], 0).pack())
             else:
                 values.append(getattr(self, field[0], 0))
-        return struct.pack(self.format(), *values)
+        return self.layout()[0].pack(*values)
 
     def unpack(self, buf):
-        values = struct.unpack(self.format(), buf)
-        keys_vals = {}
-        for i, val in enumerate(values):
-            keys_vals[self._fields_[i][0]] = val
-
-        self.init_from_dict(**keys_vals)
+        compiled, names = self.layout()
+        for name, val in zip(names, compiled.unpack(buf)):
+            setattr(self, name, val)
 
     @property
     @abstractmethod
@@ -121,6 +170,8 @@ class OP_REP_Import(BaseStructure):
 
 
 class USBIP_RET_Submit(BaseStructure):
+    __slots__ = ('command', 'seqnum', 'devid', 'direction', 'ep', 'status', 'actual_length',
+                 'start_frame', 'number_of_packets', 'error_count', 'padding', 'data')
     _byte_order_ = '>'
     _fields_ = [
         ('command', 'I'),
@@ -143,6 +194,8 @@ class USBIP_RET_Submit(BaseStructure):
 
 
 class USBIP_CMD_Submit(BaseStructure):
+    __slots__ = ('command', 'seqnum', 'devid', 'direction', 'ep', 'transfer_flags', 'transfer_buffer_length',
+                 'start_frame', 'number_of_packets', 'interval', 'setup')
     _byte_order_ = '>'
     _fields_ = [
         ('command', 'I'),
@@ -160,6 +213,7 @@ class USBIP_CMD_Submit(BaseStructure):
 
 
 class StandardDeviceRequest(BaseStructure):
+    __slots__ = ('bmRequestType', 'bRequest', 'wValue', 'wIndex', 'wLength')
     _byte_order_ = '<'  # USB uses little-endian
     _fields_ = [
         ('bmRequestType', 'B'),
@@ -229,6 +283,30 @@ class DeviceQualifierDescriptor(BaseStructure):
     ]
 
 
+class USB20ExtensionDescriptor(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bLength', 'B', 0x07),
+        ('bDescriptorType', 'B', 0x10),  # Device Capability
+        ('bDevCapabilityType', 'B', 0x02),  # USB 2.0 Extension
+        ('bmAttributes', 'I', 0),
+    ]
+
+
+class SuperSpeedUSBDeviceCapabilityDescriptor(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bLength', 'B', 0x0a),
+        ('bDescriptorType', 'B', 0x10),  # Device Capability
+        ('bDevCapabilityType', 'B', 0x03),  # SuperSpeed USB
+        ('bmAttributes', 'B', 0),
+        ('wSpeedsSupported', 'H', 0x000e),  # full, high and super speed
+        ('bFunctionalitySupport', 'B', 1),  # fully functional from full speed
+        ('bU1DevExitLat', 'B', 0x0a),
+        ('wU2DevExitLat', 'H', 0x07ff),
+    ]
+
+
 class InterfaceDescriptor(BaseStructure):
     _byte_order_ = '<'
     _fields_ = [
@@ -256,17 +334,279 @@ class EndpointDescriptor(BaseStructure):
     ]
 
 
+class SuperSpeedEndpointCompanionDescriptor(BaseStructure):
+    _byte_order_ = '<'
+    _fields_ = [
+        ('bLength', 'B', 6),
+        ('bDescriptorType', 'B', 0x30),
+        ('bMaxBurst', 'B', 0),
+        ('bmAttributes', 'B', 0),
+        ('wBytesPerInterval', 'H', 0)
+    ]
+
+
 class USBRequest():
+    __slots__ = ('seqnum', 'devid', 'direction', 'ep', 'flags', 'numberOfPackets', 'interval', 'setup',
+                 'transfer_buffer_length', 'transfer_buffer', 'buffer', 'trace')
+
     def __init__(self, **kwargs):
+        for key in self.__slots__:
+            setattr(self, key, None)
         for key, value in kwargs.items():
             setattr(self, key, value)
 
 
+class ObjectPool:
+    '''
+    Free list of reusable objects, so that the per-URB path does not allocate
+    a new command, request and return record for every URB
+    '''
+
+    def __init__(self, factory, max_free=256):
+        self.factory = factory
+        self.max_free = max_free
+        self.free = []
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+
+    def acquire(self):
+        with self.lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            if self.free:
+                self.reused += 1
+                return self.free.pop()
+            self.created += 1
+        return self.factory()
+
+    def release(self, obj):
+        with self.lock:
+            self.in_use -= 1
+            if len(self.free) < self.max_free:
+                self.free.append(obj)
+            else:
+                self.discarded += 1
+
+    def discard(self, obj):
+        # Gives up an acquired object instead of keeping it for reuse
+        with self.lock:
+            self.in_use -= 1
+            self.discarded += 1
+
+    def stats(self):
+        with self.lock:
+            return {'created': self.created,
+                    'reused': self.reused,
+                    'discarded': self.discarded,
+                    'free': len(self.free),
+                    'in_use': self.in_use,
+                    'peak_in_use': self.peak_in_use}
+
+
+cmd_pool = ObjectPool(lambda: USBIP_CMD_Submit())
+ret_pool = ObjectPool(lambda: USBIP_RET_Submit())
+control_request_pool = ObjectPool(lambda: StandardDeviceRequest())
+request_pool = ObjectPool(USBRequest)
+
+
+def pool_statistics():
+    return {'cmd_submit': cmd_pool.stats(),
+            'ret_submit': ret_pool.stats(),
+            'control_request': control_request_pool.stats(),
+            'usb_request': request_pool.stats(),
+            'buffers': buffer_pool.stats(),
+            'idle_buffer_bytes': buffer_pool.idle_bytes}
+
+
+MEMORY_CHANNEL_URB = 'urb'
+MEMORY_CHANNEL_RESPONSE = 'response'
+MEMORY_CHANNEL_IDLE = 'idle'
+
+
+class MemoryAccount:
+    '''
+    Buffer usage of one device, split by channel, charged against the
+    process-wide MemoryGovernor
+    '''
+
+    def __init__(self, governor, name):
+        self.governor = governor
+        self.name = name
+        self.channels = {}
+        self.current = 0
+        self.peak = 0
+
+    def headroom(self):
+        return self.governor.headroom(self)
+
+    def limit(self):
+        return self.governor.limit()
+
+    def charge(self, channel, nbytes):
+        self.governor.charge(self, channel, nbytes)
+
+    def reserve(self, channel, nbytes):
+        self.governor.reserve(self, channel, nbytes)
+
+    def release(self, channel, nbytes):
+        self.governor.release(self, channel, nbytes)
+
+    def usage(self):
+        with self.governor.condition:
+            return {'name': self.name,
+                    'current': self.current,
+                    'peak': self.peak,
+                    'channels': dict(self.channels)}
+
+
+class MemoryGovernor:
+    '''
+    Process-wide budget for buffered URB payloads and upstream responses.
+    Callers apply backpressure instead of buffering past the limits: the
+    USB/IP reader stops accepting URBs from the host and devices stop reading
+    from upstream.
+    '''
+
+    def __init__(self, budget=64 << 20, device_limit=16 << 20):
+        self.budget = budget
+        self.device_limit = device_limit
+        self.accounts = []
+        self.current = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def configure(self, budget=None, device_limit=None):
+        with self.condition:
+            if budget is not None:
+                self.budget = budget
+            if device_limit is not None:
+                self.device_limit = device_limit
+            self.condition.notify_all()
+
+    def account(self, name):
+        account = MemoryAccount(self, name)
+        with self.condition:
+            self.accounts.append(account)
+        return account
+
+    def limit(self):
+        # The most a single device can ever have buffered
+        with self.condition:
+            return min(self.budget, self.device_limit)
+
+    def headroom(self, account):
+        with self.condition:
+            return max(0, min(self.budget - self.current, self.device_limit - account.current))
+
+    def charge(self, account, channel, nbytes):
+        with self.condition:
+            account.channels[channel] = account.channels.get(channel, 0) + nbytes
+            account.current += nbytes
+            account.peak = max(account.peak, account.current)
+            self.current += nbytes
+            self.peak = max(self.peak, self.current)
+
+    def reserve(self, account, channel, nbytes):
+        # Waits only while the same channel holds memory that will be released,
+        # so a single oversized request can never block forever
+        with self.condition:
+            while account.channels.get(channel, 0) > 0 and \
+                    nbytes > min(self.budget - self.current, self.device_limit - account.current):
+                self.condition.wait()
+            self.charge(account, channel, nbytes)
+
+    def release(self, account, channel, nbytes):
+        with self.condition:
+            account.channels[channel] -= nbytes
+            account.current -= nbytes
+            self.current -= nbytes
+            self.condition.notify_all()
+
+    def usage(self):
+        with self.condition:
+            accounts = list(self.accounts)
+            usage = {'budget': self.budget,
+                     'device_limit': self.device_limit,
+                     'current': self.current,
+                     'peak': self.peak}
+        usage['devices'] = [account.usage() for account in accounts]
+        return usage
+
+
+memory_governor = MemoryGovernor()
+
+
+class BufferPool:
+    '''
+    Payload buffers pooled by power-of-two size class. Idle buffers are
+    capped at `max_free_bytes` and charged to the memory governor, and a
+    released buffer is dropped rather than kept when the budget is short.
+    '''
+
+    def __init__(self, governor, max_free_bytes=4 << 20, max_free_per_size=64, min_size=512):
+        self.memory = governor.account('buffer pool')
+        self.max_free_bytes = max_free_bytes
+        self.max_free_per_size = max_free_per_size
+        self.min_size = min_size
+        self.pools = {}
+        self.idle_bytes = 0
+        self.lock = threading.Lock()
+
+    def size_class(self, length):
+        size = self.min_size
+        while size < length:
+            size <<= 1
+        return size
+
+    def pool(self, size):
+        pool = self.pools.get(size)
+        if pool is None:
+            pool = self.pools[size] = ObjectPool(lambda: bytearray(size), self.max_free_per_size)
+        return pool
+
+    def acquire(self, length):
+        size = self.size_class(length)
+        with self.lock:
+            pool = self.pool(size)
+            reused = bool(pool.free)
+            buf = pool.acquire()
+            if reused:
+                self.idle_bytes -= size
+                self.memory.release(MEMORY_CHANNEL_IDLE, size)
+        return buf
+
+    def release(self, buf):
+        size = len(buf)
+        with self.lock:
+            pool = self.pool(size)
+            if len(pool.free) < pool.max_free and self.idle_bytes + size <= self.max_free_bytes and \
+                    self.memory.headroom() >= size:
+                pool.release(buf)
+                self.idle_bytes += size
+                self.memory.charge(MEMORY_CHANNEL_IDLE, size)
+            else:
+                pool.discard(buf)
+
+    def stats(self):
+        with self.lock:
+            pools = list(self.pools.items())
+        return {size: pool.stats() for size, pool in sorted(pools)}
+
+
+buffer_pool = BufferPool(memory_governor)
+
+
 class USBDevice(ABC):
     '''
     Abstract Base Class
     '''
 
+    usb_speed = 'full'
+
     @property
     @abstractmethod
     def configurations(self): pass
@@ -275,62 +615,162 @@ class USBDevice(ABC):
     @abstractmethod
     def device_descriptor(self): pass
 
-    def __init__(self):
+    @property
+    def speed_profile(self):
+        return USB_SPEED_PROFILES[self.usb_speed]
+
+    def __init__(self, descriptor_snapshot=None):
+        self.memory = memory_governor.account(getattr(self, 'device_name', type(self).__name__))
+        if descriptor_snapshot is None:
+            self.compile_descriptors()
+        else:
+            self.descriptor_snapshot = descriptor_snapshot
+
+    def compile_descriptors(self):
+        # Packs the descriptor set once; USBContainer adds the OP_REP_DEVLIST
+        # and OP_REP_IMPORT replies on first use
         self.generate_raw_configuration()
+        self.generate_raw_bos()
+        device_qualifier = self.device_qualifier_descriptor()
+        self.descriptor_snapshot = {
+            'device': self.device_descriptor.pack(),
+            'configuration': bytes(self.all_configurations),
+            'bos': self.raw_bos,
+            'device_qualifier': device_qualifier.pack() if device_qualifier is not None else None,
+            'other_speed_configuration': self.other_speed_configuration() if device_qualifier is not None else None,
+        }
 
     def generate_raw_configuration(self):
         all_configurations = bytearray()
         for configuration in self.configurations:
-            all_configurations.extend(configuration.pack())
+            descriptors = bytearray()
             for interface in configuration.interfaces:
                 for interface_alternative in interface:
-                    all_configurations.extend(interface_alternative.pack())
+                    descriptors.extend(interface_alternative.pack())
                     if hasattr(interface_alternative, 'class_descriptor'):
-                        all_configurations.extend(interface_alternative.class_descriptor.pack())
+                        descriptors.extend(interface_alternative.class_descriptor.pack())
                     for endpoint in interface_alternative.endpoints:
-                        all_configurations.extend(endpoint.pack())
+                        descriptors.extend(endpoint.pack())
+                        if hasattr(endpoint, 'companion_descriptor'):
+                            descriptors.extend(endpoint.companion_descriptor.pack())
                         if hasattr(endpoint, 'class_descriptor'):
-                            all_configurations.extend(endpoint.class_descriptor.pack())
+                            descriptors.extend(endpoint.class_descriptor.pack())
+            configuration.wTotalLength = configuration.size() + len(descriptors)
+            all_configurations.extend(configuration.pack())
+            all_configurations.extend(descriptors)
         self.all_configurations = all_configurations
 
+    def generate_raw_bos(self):
+        self.raw_bos = None
+        if not self.speed_profile['bos']:
+            return
+        capabilities = [USB20ExtensionDescriptor(), SuperSpeedUSBDeviceCapabilityDescriptor()]
+        raw_capabilities = b''.join(capability.pack() for capability in capabilities)
+        bos = BOSDescriptor(bNumDeviceCaps=len(capabilities))
+        bos.wTotalLength = bos.size() + len(raw_capabilities)
+        self.raw_bos = bos.pack() + raw_capabilities
+
+    def device_qualifier_descriptor(self):
+        # Describes the device when operating at the other (full) speed
+        if not self.speed_profile['device_qualifier']:
+            return None
+        device_descriptor = self.device_descriptor
+        return DeviceQualifierDescriptor(bcdUSB=device_descriptor.bcdUSB,
+                                         bDeviceClass=device_descriptor.bDeviceClass,
+                                         bDeviceSubClass=device_descriptor.bDeviceSubClass,
+                                         bDeviceProtocol=device_descriptor.bDeviceProtocol,
+                                         bMaxPacketSize0=0x40,
+                                         bNumConfigurations=device_descriptor.bNumConfigurations)
+
+    def other_speed_configuration(self):
+        # The configurations as they would be at full speed: same layout, with
+        # the Other Speed Configuration type and bulk packets capped at 64 bytes
+        full_speed_packet_size = USB_SPEED_PROFILES['full']['bulk_max_packet_size']
+        raw = bytearray(self.all_configurations)
+        offset = 0
+        while offset + 1 < len(raw):
+            length, descriptor_type = raw[offset], raw[offset + 1]
+            if length < 2:
+                break
+            if descriptor_type == 0x02:  # Configuration Descriptor
+                raw[offset + 1] = 0x07
+            elif descriptor_type == 0x05 and raw[offset + 3] & 0x03 == 0x02:  # Bulk Endpoint Descriptor
+                max_packet_size, = struct.unpack_from('<H', raw, offset + 4)
+                struct.pack_into('<H', raw, offset + 4, min(max_packet_size, full_speed_packet_size))
+            offset += length
+        return bytes(raw)
+
     def send_usb_ret(self, usb_req, usb_res, usb_len, status=0):
-        print(f'Sending {bytes_to_string(usb_res)}')
-        self.connection.sendall(USBIP_RET_Submit(command=0x3,
-                                                 seqnum=usb_req.seqnum,
-                                                 status=status,
-                                                 actual_length=usb_len,
-                                                 data=usb_res).pack())
+        if debug:
+            print(f'Sending {bytes_to_string(usb_res)}')
+        ret = ret_pool.acquire()
+        ret.command = 0x3
+        ret.seqnum = usb_req.seqnum
+        ret.status = status
+        ret.actual_length = usb_len
+        ret.data = usb_res
+        try:
+            self.connection.sendall(ret.pack())
+        finally:
+            ret.data = None
+            ret_pool.release(ret)
+        tracer.mark(usb_req, STAGE_COMPLETED)
 
     def handle_get_descriptor(self, control_req, usb_req):
         handled = False
         descriptor_type, descriptor_index = control_req.wValue.to_bytes(length=2, byteorder='big')
-        print(f"handle_get_descriptor {descriptor_type:n} {descriptor_index:n}")
+        if debug:
+            print(f"handle_get_descriptor {descriptor_type:n} {descriptor_index:n}")
+        snapshot = self.descriptor_snapshot
         if descriptor_type == 0x01:  # Device Descriptor
             handled = True
-            ret = self.device_descriptor.pack()
+            ret = snapshot['device']
             self.send_usb_ret(usb_req, ret, len(ret))
         elif descriptor_type == 0x02:  # Configuration Descriptor
             handled = True
-            ret = self.all_configurations[:control_req.wLength]
+            ret = snapshot['configuration'][:control_req.wLength]
             self.send_usb_ret(usb_req, ret, len(ret))
+        elif descriptor_type == 0x06:  # Device Qualifier Descriptor
+            if snapshot['device_qualifier'] is not None:
+                handled = True
+                ret = snapshot['device_qualifier'][:control_req.wLength]
+                self.send_usb_ret(usb_req, ret, len(ret))
+        elif descriptor_type == 0x07:  # Other Speed Configuration Descriptor
+            if snapshot.get('other_speed_configuration') is not None:
+                handled = True
+                ret = snapshot['other_speed_configuration'][:control_req.wLength]
+                self.send_usb_ret(usb_req, ret, len(ret))
+        elif descriptor_type == 0x0F:  # BOS Descriptor
+            if snapshot['bos'] is not None:
+                handled = True
+                ret = snapshot['bos'][:control_req.wLength]
+                self.send_usb_ret(usb_req, ret, len(ret))
 
         return handled
 
     def handle_set_configuration(self, control_req, usb_req):
         # Only supports 1 configuration
-        print(f"handle_set_configuration {control_req.wValue:n}")
+        if debug:
+            print(f"handle_set_configuration {control_req.wValue:n}")
         self.send_usb_ret(usb_req, b'', 0)
         return True
 
     def handle_usb_control(self, usb_req):
-        control_req = StandardDeviceRequest()
-        control_req.unpack(usb_req.setup)
+        control_req = control_request_pool.acquire()
+        try:
+            control_req.unpack(usb_req.setup)
+            self.dispatch_usb_control(control_req, usb_req)
+        finally:
+            control_request_pool.release(control_req)
+
+    def dispatch_usb_control(self, control_req, usb_req):
         handled = False
-        print(f"  UC Request Type {control_req.bmRequestType}")
-        print(f"  UC Request {control_req.bRequest}")
-        print(f"  UC Value  {control_req.wValue}")
-        print(f"  UC Index  {control_req.wIndex}")
-        print(f"  UC Length {control_req.wLength}")
+        if debug:
+            print(f"  UC Request Type {control_req.bmRequestType}")
+            print(f"  UC Request {control_req.bRequest}")
+            print(f"  UC Value  {control_req.wValue}")
+            print(f"  UC Index  {control_req.wIndex}")
+            print(f"  UC Length {control_req.wLength}")
         if control_req.bmRequestType == 0x80:  # Data flows IN, from Device to Host
             if control_req.bRequest == 0x00:  # GET_STATUS
                 attributes = self.configurations[0].bmAttributes
@@ -365,14 +805,155 @@ class USBDevice(ABC):
         pass
 
 
+def set_debug(enabled):
+    global debug
+    debug = enabled
+
+
 def bytes_to_string(bytes):
     if bytes:
         return ''.join(["\\x{0:02x}".format(val) for val in bytes])
     return None
 
 
+def recv_exactly_into(conn, view):
+    received = 0
+    while received < len(view):
+        count = conn.recv_into(view[received:])
+        if not count:
+            return False
+        received += count
+    return True
+
+
+URB_CLASS_CONTROL = 'control'
+URB_CLASS_SHORT = 'short'
+URB_CLASS_BULK = 'bulk'
+
+
+class URBScheduler:
+    '''
+    Queues URBs per (devid, endpoint, direction) and hands them out by
+    traffic class: control transfers on EP0 first, then short exchanges, then
+    bulk job data. A class may take at most `weight` URBs per round before
+    lower classes get a turn, and endpoints within a class are served
+    round-robin, so no endpoint is starved. URBs of one endpoint always keep
+    their order.
+
+    `endpoint_classes` maps endpoint addresses (0x80 set for IN) to a class.
+    Other bulk-OUT URBs are classified by size. Other bulk-IN URBs count as
+    bulk, since hosts submit them with large buffers whatever the size of the
+    exchange.
+    '''
+
+    priorities = (URB_CLASS_CONTROL, URB_CLASS_SHORT, URB_CLASS_BULK)
+
+    def __init__(self, weights=None, short_transfer_size=4096, max_queued=32, endpoint_classes=None):
+        self.weights = {URB_CLASS_CONTROL: 8, URB_CLASS_SHORT: 4, URB_CLASS_BULK: 1}
+        if weights:
+            self.weights.update(weights)
+        self.short_transfer_size = short_transfer_size
+        self.endpoint_classes = dict(endpoint_classes or {})
+        # Bounds how far the reader runs ahead, and so the number of URB
+        # records and payload buffers that are in flight at once
+        self.max_queued = max_queued
+        self.condition = threading.Condition()
+        self.reset()
+
+    def configure(self, weights=None, short_transfer_size=None, max_queued=None, endpoint_classes=None):
+        with self.condition:
+            if endpoint_classes is not None:
+                self.endpoint_classes = dict(endpoint_classes)
+            if weights:
+                self.weights.update(weights)
+                self.credits = dict(self.weights)
+            if short_transfer_size is not None:
+                self.short_transfer_size = short_transfer_size
+            if max_queued is not None:
+                self.max_queued = max_queued
+                self.condition.notify_all()
+
+    def reset(self):
+        with self.condition:
+            self.queues = OrderedDict()
+            self.queued = 0
+            self.credits = dict(self.weights)
+            self.closed = False
+
+    def classify(self, usb_req):
+        if usb_req.ep == 0:
+            return URB_CLASS_CONTROL
+        urb_class = self.endpoint_classes.get(usb_req.ep | (0x80 if usb_req.direction == USBIP_DIR_IN else 0))
+        if urb_class is not None:
+            return urb_class
+        if usb_req.direction == USBIP_DIR_OUT and usb_req.transfer_buffer_length <= self.short_transfer_size:
+            return URB_CLASS_SHORT
+        return URB_CLASS_BULK
+
+    def put(self, usb_req):
+        with self.condition:
+            while self.queued >= self.max_queued and not self.closed:
+                self.condition.wait()
+            key = (usb_req.devid, usb_req.ep, usb_req.direction)
+            queue = self.queues.get(key)
+            if queue is None:
+                queue = self.queues[key] = deque()
+            queue.append(usb_req)
+            self.queued += 1
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def get(self):
+        # Blocks until a URB is queued; returns None once closed and drained
+        with self.condition:
+            while 1:
+                usb_req = self.next_urb()
+                if usb_req is not None:
+                    self.queued -= 1
+                    self.condition.notify_all()
+                    return usb_req
+                if self.closed:
+                    return None
+                self.condition.wait()
+
+    def next_urb(self):
+        # An endpoint queue is classified by its head URB so that its order is kept
+        ready = {urb_class: [] for urb_class in self.priorities}
+        for key, queue in self.queues.items():
+            ready[self.classify(queue[0])].append(key)
+        pending = [urb_class for urb_class in self.priorities if ready[urb_class]]
+        if not pending:
+            return None
+        eligible = [urb_class for urb_class in pending if self.credits[urb_class] > 0]
+        if not eligible:
+            self.credits = dict(self.weights)
+            eligible = pending
+        urb_class = eligible[0]
+        self.credits[urb_class] -= 1
+
+        key = ready[urb_class][0]
+        queue = self.queues.pop(key)
+        usb_req = queue.popleft()
+        if queue:
+            self.queues[key] = queue  # re-append so the next endpoint goes first
+        return usb_req
+
+
 class USBContainer:
-    usb_devices = []
+
+    def __init__(self, scheduler=None, capture=None):
+        self.usb_devices = []
+        self.scheduler = scheduler or URBScheduler()
+        self.capture = capture
+        self.listener = None
+        self.connection = None
+        self.stopped = False
+        self.header_buffer = bytearray(USBIP_CMD_Submit().size())
+        self.header_view = memoryview(self.header_buffer)
 
     def add_usb_device(self, usb_device):
         self.usb_devices.append(usb_device)
@@ -385,7 +966,7 @@ class USBContainer:
                              busID='1-1'.encode('ascii'),
                              busnum=1,
                              devnum=2,
-                             speed=2,
+                             speed=usb_dev.speed_profile['speed'],
                              idVendor=device_descriptor.idVendor,
                              idProduct=device_descriptor.idProduct,
                              bcdDevice=device_descriptor.bcdDevice,
@@ -405,7 +986,7 @@ class USBContainer:
                               busID='1-1'.encode('ascii'),
                               busnum=1,
                               devnum=2,
-                              speed=2,
+                              speed=usb_dev.speed_profile['speed'],
                               idVendor=device_descriptor.idVendor,
                               idProduct=device_descriptor.idProduct,
                               bcdDevice=device_descriptor.bcdDevice,
@@ -419,39 +1000,39 @@ class USBContainer:
                                                       bInterfaceSubClass=usb_dev.configurations[0].interfaces[0][0].bInterfaceSubClass,
                                                       bInterfaceProtocol=usb_dev.configurations[0].interfaces[0][0].bInterfaceProtocol))
 
-    def run(self, ip='0.0.0.0', port=3240):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((ip, port))
-        s.listen()
-        attached = False
-        req = USBIPHeader()
-        while 1:
-            conn, addr = s.accept()
-            print('Connection address:', addr)
-            while 1:
-                if not attached:
-                    data = conn.recv(8)
-                    if not data:
-                        break
-                    req.unpack(data)
-                    print('Header Packet')
-                    print('command:', hex(req.command))
-                    if req.command == 0x8005:  # OP_REQ_DEVLIST
-                        print('list of devices')
-                        conn.sendall(self.handle_device_list().pack())
-                    elif req.command == 0x8003:  # OP_REQ_IMPORT
-                        print('attach device')
-                        conn.recv(32)  # receive bus id
-                        conn.sendall(self.handle_attach().pack())
-                        attached = True
-                else:
+    def receive_urb(self, conn):
+        cmd = cmd_pool.acquire()
+        try:
+            if not recv_exactly_into(conn, self.header_view):
+                return None
+            trace = tracer.begin() if tracer.enabled else None
+            cmd.unpack(self.header_buffer)
+            memory = self.usb_devices[0].memory
+            size = buffer_pool.size_class(cmd.transfer_buffer_length)
+            if size > memory.limit():
+                # No well-behaved host asks for this; drop the connection
+                # rather than allocate whatever a peer claims to send
+                raise ConnectionAbortedError(f"URB of {cmd.transfer_buffer_length} bytes exceeds the memory limit")
+            buffer = None
+            transfer_buffer = None
+            reserved = 0
+            try:
+                if cmd.direction == USBIP_DIR_OUT and cmd.transfer_buffer_length:
+                    # Blocks while queued payloads exceed the memory budget, which
+                    # leaves further URBs in the socket and throttles the host.
+                    # Charged by the pooled buffer's size, not the payload's
+                    memory.reserve(MEMORY_CHANNEL_URB, size)
+                    reserved = size
+                    buffer = buffer_pool.acquire(cmd.transfer_buffer_length)
+                    transfer_buffer = memoryview(buffer)[:cmd.transfer_buffer_length]
+                    if not recv_exactly_into(conn, transfer_buffer):
+                        self.release_payload(buffer, transfer_buffer, reserved)
+                        return None
+                if self.capture is not None:
+                    self.capture.record_received(self.header_buffer, transfer_buffer)
+                if debug:
                     print('----------------')
                     print('handles requests')
-                    cmd = USBIP_CMD_Submit()
-                    cmd_header_data = conn.recv(cmd.size())
-                    cmd.unpack(cmd_header_data)
-                    transfer_buffer = conn.recv(cmd.transfer_buffer_length) if cmd.direction == USBIP_DIR_OUT else None
                     print(f"usbip cmd {cmd.command:x}")
                     print(f"usbip seqnum {cmd.seqnum:x}")
                     print(f"usbip devid {cmd.devid:x}")
@@ -464,16 +1045,173 @@ class USBContainer:
                     print(f"usbip interval {cmd.interval:x}")
                     print(f"usbip setup {bytes_to_string(cmd.setup)}")
                     print(f"usbip transfer buffer {bytes_to_string(transfer_buffer)}")
-                    usb_req = USBRequest(seqnum=cmd.seqnum,
-                                         devid=cmd.devid,
-                                         direction=cmd.direction,
-                                         ep=cmd.ep,
-                                         flags=cmd.transfer_flags,
-                                         numberOfPackets=cmd.number_of_packets,
-                                         interval=cmd.interval,
-                                         setup=cmd.setup,
-                                         transfer_buffer=transfer_buffer)
-                    self.usb_devices[0].connection = conn
+                usb_req = request_pool.acquire()
+                usb_req.seqnum = cmd.seqnum
+                usb_req.devid = cmd.devid
+                usb_req.direction = cmd.direction
+                usb_req.ep = cmd.ep
+                usb_req.flags = cmd.transfer_flags
+                usb_req.numberOfPackets = cmd.number_of_packets
+                usb_req.interval = cmd.interval
+                usb_req.setup = cmd.setup
+                usb_req.transfer_buffer_length = cmd.transfer_buffer_length
+                usb_req.transfer_buffer = transfer_buffer
+                usb_req.buffer = buffer
+                usb_req.trace = trace
+                tracer.mark(usb_req, STAGE_DECODED)
+                return usb_req
+            except BaseException:
+                # A connection reset or an interrupt part way through the
+                # payload must not leak the reservation or the buffer
+                self.release_payload(buffer, transfer_buffer, reserved)
+                raise
+        finally:
+            cmd_pool.release(cmd)
+
+    def release_payload(self, buffer, transfer_buffer, reserved):
+        if transfer_buffer is not None:
+            transfer_buffer.release()
+        # The reservation goes first so the pool sees the headroom when
+        # deciding whether to keep the buffer
+        if reserved:
+            self.usb_devices[0].memory.release(MEMORY_CHANNEL_URB, reserved)
+        if buffer is not None:
+            buffer_pool.release(buffer)
+
+    def release_urb(self, usb_req):
+        tracer.finish(usb_req)
+        if usb_req.buffer is not None:
+            self.release_payload(usb_req.buffer, usb_req.transfer_buffer, len(usb_req.buffer))
+        usb_req.transfer_buffer = None
+        usb_req.buffer = None
+        usb_req.setup = None
+        request_pool.release(usb_req)
+
+    def read_urbs(self, conn):
+        try:
+            while 1:
+                usb_req = self.receive_urb(conn)
+                if usb_req is None:
+                    break
+                self.scheduler.put(usb_req)
+        except OSError as e:
+            print(f"Error reading URBs: {e}")
+        finally:
+            self.scheduler.close()
+
+    def serve_urbs(self, conn):
+        # URBs are read on a separate thread so that queued control and short
+        # transfers can overtake bulk data instead of waiting in the socket
+        self.scheduler.reset()
+        reader = threading.Thread(target=self.read_urbs, args=(conn,), daemon=True)
+        reader.start()
+        self.usb_devices[0].connection = conn
+        try:
+            while 1:
+                usb_req = self.scheduler.get()
+                if usb_req is None:
+                    break
+                tracer.mark(usb_req, STAGE_DISPATCHED)
+                try:
                     self.usb_devices[0].handle_usb_request(usb_req)
+                except OSError as e:
+                    # The host went away, e.g. after reattach(); drain the queue
+                    print(f"Error completing URB: {e}")
+                finally:
+                    self.release_urb(usb_req)
+        finally:
+            self.usb_devices[0].connection = None
+            self.scheduler.close()
+        reader.join()
+
+    def reattach(self, usb_device):
+        # Ends the USB/IP session of usb_device; the host has to import it
+        # again and so enumerates its current descriptors
+        connection = getattr(usb_device, 'connection', None)
+        if connection is None:
+            return
+        print('Detaching device for re-attach')
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def handle_connection(self, conn, attached):
+        # Returns whether the device is attached once the connection ends
+        if self.capture is not None:
+            conn = self.capture.wrap(conn)
+        req = USBIPHeader()
+        while 1:
+            if not attached:
+                data = conn.recv(8)
+                if not data:
+                    break
+                req.unpack(data)
+                print('Header Packet')
+                print('command:', hex(req.command))
+                if req.command == 0x8005:  # OP_REQ_DEVLIST
+                    if self.capture is not None:
+                        self.capture.record_received(data)
+                    print('list of devices')
+                    conn.sendall(self.device_list_reply())
+                elif req.command == 0x8003:  # OP_REQ_IMPORT
+                    print('attach device')
+                    bus_id = conn.recv(32)  # receive bus id
+                    if self.capture is not None:
+                        self.capture.record_received(data, bus_id)
+                    conn.sendall(self.import_reply())
+                    attached = True
+            else:
+                # Closing the connection detaches the device on the host
+                self.serve_urbs(conn)
+                attached = False
+                break
+        return attached
+
+    def device_list_reply(self):
+        snapshot = self.usb_devices[0].descriptor_snapshot
+        if snapshot.get('devlist') is None:
+            snapshot['devlist'] = self.handle_device_list().pack()
+        return snapshot['devlist']
+
+    def import_reply(self):
+        snapshot = self.usb_devices[0].descriptor_snapshot
+        if snapshot.get('import') is None:
+            snapshot['import'] = self.handle_attach().pack()
+        return snapshot['import']
+
+    def run(self, ip='0.0.0.0', port=3240):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((ip, port))
+        s.listen()
+        self.listener = s
+        attached = False
+        while not self.stopped:
+            try:
+                conn, addr = s.accept()
+            except OSError:
+                if self.stopped:
+                    break
+                raise
+            self.connection = conn
+            if self.stopped:
+                conn.close()
+                break
+            print('Connection address:', addr)
+            attached = self.handle_connection(conn, attached)
             print('Close connection\n')
-            conn.close()
\ No newline at end of file
+            self.connection = None
+            conn.close()
+        s.close()
+
+    def stop(self):
+        # Makes run() return once the current connection has wound down. Only
+        # shuts sockets down, so it is safe to call from a signal handler
+        self.stopped = True
+        for sock in (self.listener, self.connection):
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
@@ -0,0 +1,226 @@
+'''
+Compares the full, high and super speed profiles by replaying a USB/IP
+session against an IPPOverUSBDevice per profile, with a local IPP sink as
+the upstream server.
+
+Without --capture the session is synthetic: OP_REQ_IMPORT, enumeration and
+print jobs split into bulk-OUT URBs of a fixed --urb-size for every profile.
+That only compares the proxy's throughput per profile; the URB sizes are an
+input, not a result. To compare the URB sizes a host actually submits for
+each profile, record a session per profile with the capture setting and
+replay those:
+
+    python3 benchmarks/bench_speed_profiles.py --capture high=high.cap --capture full=full.cap
+'''
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import USBIP
+from USBIP import USBContainer, USB_SPEED_PROFILES, USBIP_DIR_IN, USBIP_DIR_OUT
+from ipp_printer import HTTPMessageFramer, IPPOverUSBDevice
+from usbip_capture import CAPTURE_HOST_TO_DEVICE, USBIP_CMD_SUBMIT, USBIP_PDU_HEADER_SIZE, load_capture, replay
+
+DEVID = 0x10002
+BULK_OUT_EP = 1
+BULK_IN_EP = 2
+
+
+class IPPSink:
+    '''
+    Minimal upstream IPP server: answers every complete HTTP request with a
+    small fixed response and discards the request body
+    '''
+
+    def __init__(self, response_size=256):
+        body = bytes(response_size)
+        self.response = b'HTTP/1.1 200 OK\r\nContent-Type: application/ipp\r\n' \
+                        b'Content-Length: %d\r\n\r\n' % len(body) + body
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while 1:
+            conn, _ = self.listener.accept()
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        framer = HTTPMessageFramer()
+        buffer = bytearray(1 << 16)
+        with conn:
+            while 1:
+                try:
+                    received = conn.recv_into(buffer)
+                except OSError:
+                    return
+                if not received:
+                    return
+                answered = framer.completed
+                framer.feed(memoryview(buffer)[:received])
+                for _ in range(framer.completed - answered):
+                    conn.sendall(self.response)
+
+
+def cmd_submit(seqnum, direction, ep, transfer_buffer_length, setup=bytes(8), data=b''):
+    return struct.pack('>IIIIIIIiIi8s', USBIP_CMD_SUBMIT, seqnum, DEVID, direction, ep, 0,
+                       transfer_buffer_length, 0, 0, 0, setup) + data
+
+
+def get_descriptor(seqnum, descriptor_type, length):
+    setup = struct.pack('<BBHHH', 0x80, 0x06, descriptor_type << 8, 0, length)
+    return cmd_submit(seqnum, USBIP_DIR_IN, 0, length, setup)
+
+
+def bulk_max_packet_size(configuration):
+    # wMaxPacketSize of the first bulk endpoint in a packed configuration
+    offset = 0
+    while offset < len(configuration):
+        length, descriptor_type = configuration[offset], configuration[offset + 1]
+        if descriptor_type == 0x05 and configuration[offset + 3] & 0x03 == 0x02:
+            return struct.unpack_from('<H', configuration, offset + 4)[0]
+        offset += length
+    raise ValueError("Configuration has no bulk endpoint")
+
+
+def synthetic_session(speed_profile, urb_size, jobs, job_size):
+    pdus = [struct.pack('>HHI32s', 0x0111, 0x8003, 0, b'1-1')]  # OP_REQ_IMPORT
+    seqnum = 1
+    descriptors = [(0x01, 18), (0x02, 9), (0x02, 0xFF)]
+    if speed_profile['device_qualifier']:
+        descriptors += [(0x06, 10), (0x07, 0xFF)]
+    if speed_profile['bos']:
+        descriptors += [(0x0F, 5), (0x0F, 0xFF)]
+    for descriptor_type, length in descriptors:
+        pdus.append(get_descriptor(seqnum, descriptor_type, length))
+        seqnum += 1
+    setup = struct.pack('<BBHHH', 0x00, 0x09, 1, 0, 0)  # SET_CONFIGURATION
+    pdus.append(cmd_submit(seqnum, USBIP_DIR_OUT, 0, 0, setup))
+    seqnum += 1
+
+    body = bytes(job_size)
+    request = b'POST /ipp/print HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/ipp\r\n' \
+              b'Content-Length: %d\r\n\r\n' % len(body) + body
+    for _ in range(jobs):
+        for offset in range(0, len(request), urb_size):
+            chunk = request[offset:offset + urb_size]
+            pdus.append(cmd_submit(seqnum, USBIP_DIR_OUT, BULK_OUT_EP, len(chunk), data=chunk))
+            seqnum += 1
+        pdus.append(cmd_submit(seqnum, USBIP_DIR_IN, BULK_IN_EP, urb_size))
+        seqnum += 1
+    return [(0, CAPTURE_HOST_TO_DEVICE, pdu) for pdu in pdus]
+
+
+def transfer_lengths(records):
+    lengths = Counter()
+    for _, direction, pdu in records:
+        if direction != CAPTURE_HOST_TO_DEVICE or len(pdu) < USBIP_PDU_HEADER_SIZE:
+            continue
+        command, _, _, _, ep = struct.unpack_from('>IIIII', pdu)
+        if command == USBIP_CMD_SUBMIT and ep != 0:
+            lengths[struct.unpack_from('>I', pdu, 24)[0]] += 1
+    return lengths
+
+
+def run_profile(profile, sink, cache_dir, args):
+    config_file = os.path.join(cache_dir, f'{profile}.json')
+    with open(config_file, 'w') as f:
+        json.dump({'ipp_server_url': f'http://127.0.0.1:{sink.port}/ipp/print',
+                   'usb_speed': profile,
+                   'debug': False,
+                   'descriptor_cache_dir': cache_dir}, f)
+    ipp_device = IPPOverUSBDevice(config_file)
+    USBIP.set_debug(False)
+    usb_container = USBContainer()
+    usb_container.add_usb_device(ipp_device)
+
+    # The numbers are only meaningful if this device answers the replay
+    speed_profile = USB_SPEED_PROFILES[profile]
+    assert usb_container.usb_devices == [ipp_device]
+    assert ipp_device.speed_profile is speed_profile
+    assert usb_container.handle_attach().speed == speed_profile['speed']
+    assert ipp_device.device_descriptor.bcdUSB == speed_profile['bcdUSB']
+
+    max_packet_size = bulk_max_packet_size(ipp_device.descriptor_snapshot['configuration'])
+    assert max_packet_size == speed_profile['bulk_max_packet_size']
+    source = 'capture' if profile in args.capture else 'synthetic'
+    if source == 'capture':
+        records = load_capture(args.capture[profile])
+    else:
+        records = synthetic_session(speed_profile, args.urb_size, args.jobs, args.job_size)
+    try:
+        stats = replay(usb_container, records)
+    finally:
+        ipp_device.disconnect_from_server()
+
+    lengths = transfer_lengths(records)
+    urbs = sum(lengths.values())
+    payload = sum(length * count for length, count in lengths.items())
+    stats.update(profile=profile,
+                 source=source,
+                 max_packet_size=max_packet_size,
+                 urbs=urbs,
+                 bytes_per_urb=payload / urbs if urbs else 0.0,
+                 packets_per_urb=payload / urbs / max_packet_size if urbs else 0.0,
+                 megabytes_per_second=stats['bytes_in'] / stats['elapsed'] / 1e6,
+                 lengths=lengths)
+    return stats
+
+
+def parse_capture(value):
+    profile, _, path = value.partition('=')
+    if profile not in USB_SPEED_PROFILES or not path:
+        raise argparse.ArgumentTypeError(f"expected PROFILE=path with PROFILE one of {', '.join(USB_SPEED_PROFILES)}")
+    return profile, path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare URB sizes and throughput of the USB speed profiles')
+    parser.add_argument('--profiles', nargs='+', default=list(USB_SPEED_PROFILES), choices=list(USB_SPEED_PROFILES))
+    parser.add_argument('--jobs', type=int, default=20, help='print jobs per synthetic session')
+    parser.add_argument('--job-size', type=int, default=1 << 20, help='bytes per synthetic print job')
+    parser.add_argument('--urb-size', type=int, default=16384,
+                        help='bulk URB size of synthetic sessions, the same for every profile')
+    parser.add_argument('--capture', type=parse_capture, action='append', default=[],
+                        help='replay a recorded session for a profile instead, as PROFILE=path')
+    args = parser.parse_args()
+    args.capture = dict(args.capture)
+
+    sink = IPPSink()
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for profile in args.profiles:
+            results.append(run_profile(profile, sink, cache_dir, args))
+
+    print()
+    print(f'{"profile":<8} {"session":<10} {"wMaxPkt":>8} {"URBs":>8} {"PDUs/s":>10} {"MB/s":>8} '
+          f'{"bytes/URB":>10} {"pkts/URB":>9} {"elapsed s":>10}')
+    for stats in results:
+        print(f'{stats["profile"]:<8} {stats["source"]:<10} {stats["max_packet_size"]:>8} {stats["urbs"]:>8} '
+              f'{stats["pdus_per_second"]:>10.0f} {stats["megabytes_per_second"]:>8.1f} '
+              f'{stats["bytes_per_urb"]:>10.0f} {stats["packets_per_urb"]:>9.1f} {stats["elapsed"]:>10.3f}')
+
+    if any(stats['source'] == 'synthetic' for stats in results):
+        print()
+        print(f'Synthetic sessions measure throughput only, at a fixed URB size of {args.urb_size} bytes; '
+              f'pass --capture PROFILE=path with sessions recorded from a real host to compare URB sizes.')
+
+    for stats in results:
+        if stats['source'] != 'capture':
+            continue
+        print()
+        print(f'{stats["profile"]}: transfer_buffer_length distribution of bulk URBs')
+        for length, count in sorted(stats['lengths'].items()):
+            print(f'{length:>10} {count:>8} {100 * count / stats["urbs"]:>6.1f}%')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+'''
+Measures startup cost of the proxy: the import time of ipp_printer, and the
+time from process start until run() accepts connections, with the
+descriptor snapshot cache disabled, cold and warm.
+'''
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TIMED_IMPORT = 'import time; started = time.perf_counter(); import ipp_printer; print(time.perf_counter() - started)'
+
+
+def importtime(runs):
+    # Cumulative microseconds per module from -X importtime, median over runs
+    samples = {}
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ipp_printer'],
+                                cwd=ROOT, capture_output=True, text=True, check=True)
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            samples.setdefault(name.strip(), []).append(int(cumulative))
+    return {name: statistics.median(values) for name, values in samples.items()}
+
+
+def timed_import(runs):
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', TIMED_IMPORT], cwd=ROOT, capture_output=True, text=True,
+                                check=True)
+        samples.append(float(result.stdout.splitlines()[-1]))
+    return statistics.median(samples)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def time_to_listen(work_dir, port, timeout=10.0):
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'ipp_printer.py')], cwd=work_dir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while 1:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1.0).close()
+                return time.perf_counter() - started
+            except ConnectionRefusedError:
+                if process.poll() is not None:
+                    raise RuntimeError(f"ipp_printer.py exited with {process.returncode} before listening")
+                if time.perf_counter() - started > timeout:
+                    raise RuntimeError(f"ipp_printer.py did not listen within {timeout}s")
+                time.sleep(0.001)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+
+
+def listen_times(runs):
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        cache_dir = os.path.join(work_dir, 'cache')
+        port = free_port()
+        for mode in ('disabled', 'cold', 'warm'):
+            with open(os.path.join(work_dir, 'ipp_usb_config.json'), 'w') as f:
+                json.dump({'listen_ip': '127.0.0.1',
+                           'listen_port': port,
+                           'debug': False,
+                           'descriptor_cache_dir': None if mode == 'disabled' else cache_dir}, f)
+            if mode == 'warm':
+                time_to_listen(work_dir, port)
+            samples = []
+            for _ in range(runs):
+                if mode == 'cold':
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+                samples.append(time_to_listen(work_dir, port))
+            results[mode] = samples
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import time and time-to-listening-socket of the proxy')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10, help='slowest imports to list')
+    args = parser.parse_args()
+
+    imports = importtime(args.runs)
+    print(f'import ipp_printer: {timed_import(args.runs) * 1000:.1f} ms timed, '
+          f'{imports["ipp_printer"] / 1000:.1f} ms cumulative per -X importtime (median of {args.runs})')
+    print(f'{"module":<40} {"cumulative ms":>14}')
+    for name, cumulative in sorted(imports.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'{name:<40} {cumulative / 1000:>14.1f}')
+
+    print()
+    print(f'{"descriptor cache":<18} {"median ms":>10} {"min ms":>10} {"max ms":>10}')
+    for mode, samples in listen_times(args.runs).items():
+        print(f'{mode:<18} {statistics.median(samples) * 1000:>10.1f} {min(samples) * 1000:>10.1f} '
+              f'{max(samples) * 1000:>10.1f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,209 @@
 import json
+import os
+import signal
 import socket
 import threading
-import time
-import requests
+import zlib
+from collections import deque
 from urllib.parse import urlparse
-from USBIP import BaseStructure, USBDevice, InterfaceDescriptor, DeviceDescriptor, DeviceConfiguration, EndpointDescriptor, USBContainer
+from usbip_trace import STAGE_UPSTREAM_END, STAGE_UPSTREAM_START, install_signal_handler, tracer
+import USBIP
+from USBIP import USBDevice, InterfaceDescriptor, DeviceDescriptor, DeviceConfiguration, EndpointDescriptor, \
+    SuperSpeedEndpointCompanionDescriptor, USBContainer, USB_SPEED_PROFILES, USBIP_DIR_IN, \
+    MEMORY_CHANNEL_RESPONSE, memory_governor, set_debug
+
+
+# Settings that change the descriptors and so need a re-attach of the device
+DESCRIPTOR_CONFIG_KEYS = ('vendor_id', 'product_id', 'usb_speed')
+
+# The second interface carries the short status exchanges, e.g.
+# Get-Printer-Attributes, so they are not queued behind job data
+DEFAULT_ENDPOINT_CLASSES = {'0x03': 'short', '0x84': 'short'}
+
+# Bump when the layout of the cached descriptor snapshot changes
+DESCRIPTOR_SNAPSHOT_VERSION = 2
+
+HTTP_IDLE = 'idle'
+HTTP_HEADERS = 'headers'
+HTTP_BODY = 'body'
+HTTP_CHUNK_SIZE = 'chunk_size'
+HTTP_CHUNK_DATA = 'chunk_data'
+HTTP_CHUNK_END = 'chunk_end'
+HTTP_TRAILERS = 'trailers'
+HTTP_UNTIL_CLOSE = 'until_close'
+
+HTTP_MAX_LINE = 64 << 10
+
+
+class HTTPMessageFramer:
+    '''
+    Follows the HTTP/1.1 messages in one direction of the IPP connection to
+    tell where each one ends. Bodies are skipped over, not buffered. A
+    response framer is given the request framer of the other direction,
+    since whether a response has a body depends on the request method.
+    '''
+    
+    def __init__(self, requests=None):
+        self.responses = requests is not None
+        self.requests = requests
+        # Methods of the requests still waiting for a response, only kept
+        # when a response framer follows this one
+        self.methods = None
+        if requests is not None:
+            requests.methods = deque()
+        self.reset()
+    
+    def reset(self):
+        if self.methods is not None:
+            self.methods.clear()
+        self.state = HTTP_IDLE
+        self.line = bytearray()
+        self.start_line = b''
+        self.content_length = None
+        self.chunked = False
+        self.remaining = 0
+        self.completed = 0
+    
+    def idle(self):
+        # Between messages, and not part way into the start line of the next
+        return self.state == HTTP_IDLE and not self.line
+    
+    def feed(self, data):
+        view = memoryview(data)
+        offset = 0
+        while offset < len(view) and self.state != HTTP_UNTIL_CLOSE:
+            if self.state in (HTTP_BODY, HTTP_CHUNK_DATA):
+                skipped = min(self.remaining, len(view) - offset)
+                offset += skipped
+                self.remaining -= skipped
+                if not self.remaining:
+                    if self.state == HTTP_BODY:
+                        self.finish()
+                    else:
+                        self.state = HTTP_CHUNK_END
+                continue
+            
+            # Start lines, headers and chunk sizes are short, so only a small
+            # window is copied to look for the end of the line
+            window = bytes(view[offset:offset + 256])
+            end = window.find(b'\n')
+            if end < 0:
+                self.line += window
+                offset += len(window)
+                if len(self.line) > HTTP_MAX_LINE:
+                    self.state = HTTP_UNTIL_CLOSE
+                continue
+            self.line += window[:end]
+            offset += end + 1
+            line = bytes(self.line).rstrip(b'\r')
+            self.line.clear()
+            try:
+                self.handle_line(line)
+            except ValueError:
+                # Framing is lost, so the exchange only ends with the connection
+                self.state = HTTP_UNTIL_CLOSE
+    
+    def handle_line(self, line):
+        if self.state == HTTP_IDLE:
+            if line:
+                self.start_line = line
+                if self.methods is not None:
+                    self.methods.append(line.split(b' ', 1)[0])
+                self.content_length = None
+                self.chunked = False
+                self.state = HTTP_HEADERS
+        elif self.state == HTTP_HEADERS:
+            if line:
+                name, _, value = line.partition(b':')
+                name = name.strip().lower()
+                if name == b'content-length':
+                    self.content_length = int(value)
+                elif name == b'transfer-encoding':
+                    self.chunked = value.strip().lower().endswith(b'chunked')
+            else:
+                self.end_of_headers()
+        elif self.state == HTTP_CHUNK_SIZE:
+            self.remaining = int(line.split(b';')[0], 16)
+            self.state = HTTP_CHUNK_DATA if self.remaining else HTTP_TRAILERS
+        elif self.state == HTTP_CHUNK_END:
+            self.state = HTTP_CHUNK_SIZE
+        elif self.state == HTTP_TRAILERS:
+            if not line:
+                self.finish()
+    
+    def end_of_headers(self):
+        if self.responses:
+            status = int(self.start_line.split()[1])
+            if 100 <= status < 200 and status != 101:
+                # Interim response, the final one follows
+                self.state = HTTP_IDLE
+                return
+            methods = self.requests.methods
+            method = methods.popleft() if methods else None
+            if status == 101 or (method == b'CONNECT' and 200 <= status < 300):
+                # The connection now carries another protocol until it closes
+                self.state = HTTP_UNTIL_CLOSE
+                return
+            if method == b'HEAD' or status in (204, 304):
+                # No body, whatever Content-Length says
+                self.finish()
+                return
+        if self.chunked:
+            self.state = HTTP_CHUNK_SIZE
+        elif self.content_length:
+            self.remaining = self.content_length
+            self.state = HTTP_BODY
+        elif self.content_length == 0 or not self.responses:
+            self.finish()
+        else:
+            self.state = HTTP_UNTIL_CLOSE
+    
+    def finish(self):
+        self.completed += 1
+        self.state = HTTP_IDLE
+    
+    def close(self):
+        # The peer closed the connection, which ends a body read until close
+        if self.state == HTTP_UNTIL_CLOSE:
+            self.finish()
+
+
+def default_cache_dir():
+    # The per-user cache directory, as the config file's directory is often
+    # read-only under a system install
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'virtualippusb')
 
 
 class IPPOverUSBDevice(USBDevice):
     
     def __init__(self, config_file='ipp_usb_config.json'):
+        self.config_file = config_file
         self.config = self.load_config(config_file)
+        self.apply_config()
+        
+        self._device_descriptor = self.create_device_descriptor()
+        self._configurations = self.create_configurations()
+        
+        super().__init__(self.load_descriptor_snapshot())
+        
+        self.tcp_connection = None
+        self.tcp_connected = False
+        self.upstream_changed = False
+        self.connection_lock = threading.Lock()
+        self.pending_response = bytearray()
+        self.upstream_paused = False
+        self.request_framer = HTTPMessageFramer()
+        self.response_framer = HTTPMessageFramer(requests=self.request_framer)
+        
+        print(f"IPP over USB Proxy Device")
+        print(f"Configuration: {config_file}")
+        print(f"IPP Server URL: {self.server_url}")
+        print(f"Device: {self.device_name}")
+        print(f"Vendor ID: 0x{self.vendor_id:04X}, Product ID: 0x{self.product_id:04X}")
+        print(f"USB speed: {self.usb_speed}")
+    
+    def apply_config(self):
         self.server_url = self.config.get('ipp_server_url', 'http://localhost:631/ipp/print')
         self.device_name = self.config.get('device_name', 'Virtual IPP Printer')
         
@@ -29,20 +222,72 @@ class IPPOverUSBDevice(USBDevice):
         else:
             self.product_id = product_id
         
-        self._device_descriptor = self.create_device_descriptor()
-        self._configurations = self.create_configurations()
+        self.usb_speed = self.config.get('usb_speed', 'high')
+        if self.usb_speed not in USB_SPEED_PROFILES:
+            raise ValueError(f"Unsupported usb_speed '{self.usb_speed}', expected one of {', '.join(USB_SPEED_PROFILES)}")
+    
+    def reload_config(self):
+        # Returns True when the descriptors changed and the device has to be re-attached
+        old_config = self.config
+        old_server_url = self.server_url
+        try:
+            with open(self.config_file, 'r') as f:
+                self.config = json.load(f)
+            self.apply_config()
+        except (OSError, ValueError) as e:
+            print(f"Keeping previous configuration, reload failed: {e}")
+            self.config = old_config
+            self.apply_config()
+            return False
         
-        super().__init__()
+        if self.server_url != old_server_url:
+            print(f"IPP Server URL: {self.server_url} (used from the next exchange)")
+            self.upstream_changed = True
         
-        self.tcp_connection = None
-        self.tcp_connected = False
-        self.connection_lock = threading.Lock()
+        if all(old_config.get(key) == self.config.get(key) for key in DESCRIPTOR_CONFIG_KEYS):
+            return False
         
-        print(f"IPP over USB Proxy Device")
-        print(f"Configuration: {config_file}")
-        print(f"IPP Server URL: {self.server_url}")
-        print(f"Device: {self.device_name}")
-        print(f"Vendor ID: 0x{self.vendor_id:04X}, Product ID: 0x{self.product_id:04X}")
+        print(f"Descriptors changed: Vendor ID: 0x{self.vendor_id:04X}, Product ID: 0x{self.product_id:04X}, "
+              f"USB speed: {self.usb_speed}")
+        self._device_descriptor = self.create_device_descriptor()
+        self._configurations = self.create_configurations()
+        self.compile_descriptors()
+        return True
+    
+    def descriptor_snapshot_path(self):
+        # Keyed by everything the packed descriptors and replies depend on;
+        # None when the cache is disabled
+        cache_dir = self.config.get('descriptor_cache_dir', default_cache_dir())
+        if cache_dir is None:
+            return None
+        key = json.dumps({'version': DESCRIPTOR_SNAPSHOT_VERSION,
+                          'config': {name: self.config.get(name) for name in DESCRIPTOR_CONFIG_KEYS},
+                          'sources': [os.stat(source).st_mtime_ns for source in (__file__, USBIP.__file__)]},
+                         sort_keys=True)
+        return os.path.join(cache_dir, f"{zlib.crc32(key.encode('ascii')):08x}.json")
+    
+    def load_descriptor_snapshot(self):
+        path = self.descriptor_snapshot_path()
+        if path is None:
+            return None
+        try:
+            with open(path, 'r') as f:
+                snapshot = json.load(f)
+            return {name: bytes.fromhex(value) if value is not None else None for name, value in snapshot.items()}
+        except (OSError, ValueError):
+            return None
+    
+    def save_descriptor_snapshot(self):
+        path = self.descriptor_snapshot_path()
+        if path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump({name: value.hex() if value is not None else None
+                           for name, value in self.descriptor_snapshot.items()}, f)
+        except OSError as e:
+            print(f"Failed to save descriptor snapshot: {e}")
     
     def load_config(self, config_file):
         try:
@@ -59,7 +304,8 @@ class IPPOverUSBDevice(USBDevice):
                 "serial": "VIP001",
                 "listen_ip": "0.0.0.0",
                 "listen_port": 3240,
-                "debug": True
+                "usb_speed": "high",
+                "debug": False
             }
             with open(config_file, 'w') as f:
                 json.dump(default_config, f, indent=2)
@@ -68,10 +314,11 @@ class IPPOverUSBDevice(USBDevice):
     
     def create_device_descriptor(self):
         return DeviceDescriptor(
+            bcdUSB=self.speed_profile['bcdUSB'],
             bDeviceClass=0x00,
             bDeviceSubClass=0x00,
             bDeviceProtocol=0x00,
-            bMaxPacketSize0=0x40,
+            bMaxPacketSize0=self.speed_profile['bMaxPacketSize0'],
             idVendor=self.vendor_id,
             idProduct=self.product_id,
             bcdDevice=0x0100,
@@ -79,6 +326,8 @@ class IPPOverUSBDevice(USBDevice):
         )
     
     def create_configurations(self):
+        max_packet_size = self.speed_profile['bulk_max_packet_size']
+        
         ipp_interface = InterfaceDescriptor(
             bInterfaceNumber=0,
             bAlternateSetting=0,
@@ -92,14 +341,14 @@ class IPPOverUSBDevice(USBDevice):
         bulk_out_endpoint = EndpointDescriptor(
             bEndpointAddress=0x01,
             bmAttributes=0x02,
-            wMaxPacketSize=0x0200,
+            wMaxPacketSize=max_packet_size,
             bInterval=0x00
         )
         
         bulk_in_endpoint = EndpointDescriptor(
             bEndpointAddress=0x82,
             bmAttributes=0x02,
-            wMaxPacketSize=0x0200,
+            wMaxPacketSize=max_packet_size,
             bInterval=0x00
         )
         
@@ -119,21 +368,25 @@ class IPPOverUSBDevice(USBDevice):
         bulk_out_endpoint2 = EndpointDescriptor(
             bEndpointAddress=0x03,
             bmAttributes=0x02,
-            wMaxPacketSize=0x0200,
+            wMaxPacketSize=max_packet_size,
             bInterval=0x00
         )
         
         bulk_in_endpoint2 = EndpointDescriptor(
             bEndpointAddress=0x84,
             bmAttributes=0x02,
-            wMaxPacketSize=0x0200,
+            wMaxPacketSize=max_packet_size,
             bInterval=0x00
         )
         
         ipp_interface2.endpoints = [bulk_out_endpoint2, bulk_in_endpoint2]
         
+        if self.speed_profile['bos']:
+            for endpoint in ipp_interface.endpoints + ipp_interface2.endpoints:
+                endpoint.companion_descriptor = SuperSpeedEndpointCompanionDescriptor()
+        
+        # wTotalLength is filled in by generate_raw_configuration
         config = DeviceConfiguration(
-            wTotalLength=0x0039,
             bNumInterfaces=2,
             bConfigurationValue=1,
             iConfiguration=0,
@@ -171,6 +424,8 @@ class IPPOverUSBDevice(USBDevice):
                 self.tcp_connection.settimeout(10.0)
                 self.tcp_connection.connect((host, port))
                 self.tcp_connected = True
+                self.request_framer.reset()
+                self.response_framer.reset()
                 
             print("Successfully connected to IPP server")
             return True
@@ -196,11 +451,32 @@ class IPPOverUSBDevice(USBDevice):
                     pass
                 self.tcp_connection = None
             self.tcp_connected = False
+            self.request_framer.reset()
+            self.response_framer.reset()
+    
+    def at_exchange_boundary(self):
+        # True when every request sent so far has been answered in full and
+        # the host has read all of it, so nothing is lost by reconnecting
+        if not self.tcp_connected:
+            return True
+        return self.request_framer.idle() and self.response_framer.idle() and \
+            self.response_framer.completed >= self.request_framer.completed and \
+            not self.pending_response
+    
+    def receive_response(self, nbytes):
+        response = self.tcp_connection.recv(nbytes)
+        if response:
+            self.response_framer.feed(response)
+        else:
+            self.response_framer.close()
+        return response
     
     def handle_data(self, usb_req):
-        if usb_req.ep == 0x01 or usb_req.ep == 0x03:
+        # USB/IP carries the endpoint number and the direction separately
+        endpoint_address = usb_req.ep | (0x80 if usb_req.direction == USBIP_DIR_IN else 0)
+        if endpoint_address == 0x01 or endpoint_address == 0x03:
             self.handle_bulk_out(usb_req)
-        elif usb_req.ep == 0x82 or usb_req.ep == 0x84:
+        elif endpoint_address == 0x82 or endpoint_address == 0x84:
             self.handle_bulk_in(usb_req)
         else:
             print(f"Unknown endpoint: {usb_req.ep:02x}")
@@ -212,7 +488,14 @@ class IPPOverUSBDevice(USBDevice):
                 self.send_usb_ret(usb_req, b'', 0)
                 return
             
-            print(f"Received {len(usb_req.transfer_buffer)} bytes from host")
+            if USBIP.debug:
+                print(f"Received {len(usb_req.transfer_buffer)} bytes from host")
+            
+            # A changed server URL is only switched to between exchanges, never
+            # in the middle of a request or while its response is outstanding
+            if self.upstream_changed and self.at_exchange_boundary():
+                self.upstream_changed = False
+                self.disconnect_from_server()
             
             if not self.tcp_connected:
                 if not self.connect_to_server():
@@ -222,21 +505,35 @@ class IPPOverUSBDevice(USBDevice):
             try:
                 with self.connection_lock:
                     if self.tcp_connection and self.tcp_connected:
-                        self.tcp_connection.send(usb_req.transfer_buffer)
-                        print(f"Forwarded {len(usb_req.transfer_buffer)} bytes to IPP server")
+                        tracer.mark(usb_req, STAGE_UPSTREAM_START)
+                        self.tcp_connection.sendall(usb_req.transfer_buffer)
+                        self.request_framer.feed(usb_req.transfer_buffer)
+                        if USBIP.debug:
+                            print(f"Forwarded {len(usb_req.transfer_buffer)} bytes to IPP server")
                         
-                        self.tcp_connection.settimeout(0.1)
-                        try:
-                            response = self.tcp_connection.recv(8192)
-                            if response:
-                                print(f"Received immediate response: {len(response)} bytes")
-                                if not hasattr(self, 'pending_response'):
-                                    self.pending_response = bytearray()
-                                self.pending_response.extend(response)
-                        except socket.timeout:
-                            pass
-                        finally:
-                            self.tcp_connection.settimeout(10.0)
+                        # Leave the response in the socket once the memory budget is
+                        # used up, so TCP flow control pauses the IPP server
+                        headroom = self.memory.headroom()
+                        if (headroom == 0) != self.upstream_paused:
+                            self.upstream_paused = headroom == 0
+                            print("Memory limit reached, pausing reads from IPP server" if self.upstream_paused
+                                  else "Memory available, resuming reads from IPP server")
+                        if headroom > 0:
+                            # Only wait for an answer once the request is complete,
+                            # part way through it the server has nothing to send
+                            self.tcp_connection.settimeout(0.1 if self.request_framer.idle() else 0.0)
+                            try:
+                                response = self.receive_response(min(8192, headroom))
+                                if response:
+                                    if USBIP.debug:
+                                        print(f"Received immediate response: {len(response)} bytes")
+                                    self.pending_response.extend(response)
+                                    self.memory.charge(MEMORY_CHANNEL_RESPONSE, len(response))
+                            except (socket.timeout, BlockingIOError):
+                                pass
+                            finally:
+                                self.tcp_connection.settimeout(10.0)
+                        tracer.mark(usb_req, STAGE_UPSTREAM_END)
                         
                         self.send_usb_ret(usb_req, b'', len(usb_req.transfer_buffer))
                     else:
@@ -253,14 +550,13 @@ class IPPOverUSBDevice(USBDevice):
     
     def handle_bulk_in(self, usb_req):
         try:
-            if hasattr(self, 'pending_response') and self.pending_response:
+            if self.pending_response:
                 data_to_send = bytes(self.pending_response[:usb_req.transfer_buffer_length])
-                self.pending_response = self.pending_response[len(data_to_send):]
+                del self.pending_response[:len(data_to_send)]
+                self.memory.release(MEMORY_CHANNEL_RESPONSE, len(data_to_send))
                 
-                if not self.pending_response:
-                    delattr(self, 'pending_response')
-                
-                print(f"Sending {len(data_to_send)} bytes to host from buffer")
+                if USBIP.debug:
+                    print(f"Sending {len(data_to_send)} bytes to host from buffer")
                 self.send_usb_ret(usb_req, data_to_send, len(data_to_send))
                 return
             
@@ -272,10 +568,13 @@ class IPPOverUSBDevice(USBDevice):
                 with self.connection_lock:
                     if self.tcp_connection and self.tcp_connected:
                         self.tcp_connection.settimeout(0.1)
+                        tracer.mark(usb_req, STAGE_UPSTREAM_START)
                         try:
-                            response = self.tcp_connection.recv(usb_req.transfer_buffer_length)
+                            response = self.receive_response(usb_req.transfer_buffer_length)
+                            tracer.mark(usb_req, STAGE_UPSTREAM_END)
                             if response:
-                                print(f"Received {len(response)} bytes from IPP server")
+                                if USBIP.debug:
+                                    print(f"Received {len(response)} bytes from IPP server")
                                 self.send_usb_ret(usb_req, response, len(response))
                             else:
                                 self.send_usb_ret(usb_req, b'', 0)
@@ -295,6 +594,9 @@ class IPPOverUSBDevice(USBDevice):
             print(f"Error in bulk_in handler: {e}")
             self.send_usb_ret(usb_req, b'', 0, status=1)
     
+    def memory_usage(self):
+        return self.memory.usage()
+    
     def handle_device_specific_control(self, control_req, usb_req):
         if control_req.bmRequestType == 0xA1:
             if control_req.bRequest == 0x01:  # GET_DEVICE_ID
@@ -325,12 +627,103 @@ class IPPOverUSBDevice(USBDevice):
         self.send_usb_ret(usb_req, b'', 0, status=1)
 
 
+def apply_runtime_config(config, usb_container):
+    set_debug(config.get('debug', False))
+    
+    memory_config = config.get('memory', {})
+    memory_governor.configure(budget=memory_config.get('budget'),
+                              device_limit=memory_config.get('device_limit'))
+    
+    scheduler_config = config.get('scheduler', {})
+    endpoint_classes = scheduler_config.get('endpoint_classes', DEFAULT_ENDPOINT_CLASSES)
+    usb_container.scheduler.configure(weights=scheduler_config.get('weights'),
+                                      short_transfer_size=scheduler_config.get('short_transfer_size', 4096),
+                                      max_queued=scheduler_config.get('max_queued', 32),
+                                      endpoint_classes={int(address, 16) if isinstance(address, str) else address:
+                                                        urb_class for address, urb_class in endpoint_classes.items()})
+    
+    tracing_config = config.get('tracing', {})
+    tracer.configure(duration=tracing_config.get('duration', 30),
+                     sample_rate=tracing_config.get('sample_rate', 1.0),
+                     profile_interval=tracing_config.get('profile_interval', 0.005),
+                     report_dir=tracing_config.get('report_dir', '.'))
+
+
+def config_mtime(config_file):
+    try:
+        return os.stat(config_file).st_mtime_ns
+    except OSError:
+        return None
+
+
+def watch_config(ipp_device, usb_container, reload_requested):
+    # Reloads on SIGHUP and, if config_watch_interval is set, when the file changes
+    last_mtime = config_mtime(ipp_device.config_file)
+    while 1:
+        interval = ipp_device.config.get('config_watch_interval')
+        requested = reload_requested.wait(interval)
+        reload_requested.clear()
+        mtime = config_mtime(ipp_device.config_file)
+        if not requested and mtime == last_mtime:
+            continue
+        last_mtime = mtime
+        
+        print(f"Reloading configuration from {ipp_device.config_file}")
+        if ipp_device.reload_config():
+            usb_container.reattach(ipp_device)
+        apply_runtime_config(ipp_device.config, usb_container)
+
+
+def save_capture(capture, capture_config):
+    capture_path = capture_config.get('path', 'usbip_session.cap')
+    capture.save(capture_path)
+    capture.save_pcap(capture_config.get('pcap_path', capture_path + '.pcap'))
+    print(f"Saved USB/IP session capture to {capture_path}")
+
+
+def flush_capture(capture, capture_config, flush_requested):
+    # Saves on SIGUSR2 and, if flush_interval is set, periodically
+    while 1:
+        flush_requested.wait(capture_config.get('flush_interval'))
+        flush_requested.clear()
+        try:
+            save_capture(capture, capture_config)
+        except OSError as e:
+            print(f"Error saving capture: {e}")
+
+
 def main():
+    capture = None
     try:
         ipp_device = IPPOverUSBDevice()
         
-        usb_container = USBContainer()
+        capture_config = ipp_device.config.get('capture', {})
+        if capture_config.get('enabled', False):
+            from usbip_capture import CaptureRing
+            
+            capture = CaptureRing(capture_config.get('ring_size', 16 << 20))
+        usb_container = USBContainer(capture=capture)
         usb_container.add_usb_device(ipp_device)
+        # On e.g. systemctl stop, run() returns and the finally below saves
+        # the capture; nothing is raised inside the code that was interrupted
+        signal.signal(signal.SIGTERM, lambda signum, frame: usb_container.stop())
+        
+        if ipp_device.descriptor_snapshot.get('import') is None:
+            usb_container.device_list_reply()
+            usb_container.import_reply()
+            ipp_device.save_descriptor_snapshot()
+        apply_runtime_config(ipp_device.config, usb_container)
+        
+        if capture is not None:
+            flush_requested = threading.Event()
+            signal.signal(signal.SIGUSR2, lambda signum, frame: flush_requested.set())
+            threading.Thread(target=flush_capture, args=(capture, capture_config, flush_requested),
+                             daemon=True).start()
+        install_signal_handler()
+        reload_requested = threading.Event()
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
+        threading.Thread(target=watch_config, args=(ipp_device, usb_container, reload_requested),
+                         daemon=True).start()
         
         # get listen settings from config
         listen_ip = ipp_device.config.get('listen_ip', '0.0.0.0')
@@ -350,6 +743,8 @@ def main():
     finally:
         if 'ipp_device' in locals():
             ipp_device.disconnect_from_server()
+        if capture is not None:
+            save_capture(capture, capture_config)
 
 
 if __name__ == "__main__":
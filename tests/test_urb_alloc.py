@@ -0,0 +1,113 @@
+import socket
+import threading
+import tracemalloc
+
+import USBIP
+from USBIP import USBDevice, USBContainer, USBIP_CMD_Submit, DeviceDescriptor, DeviceConfiguration, \
+    InterfaceDescriptor, EndpointDescriptor, USBIP_DIR_OUT
+
+PAYLOAD_SIZE = 4096
+WARMUP_URBS = 500
+MEASURED_URBS = 5000
+
+
+class SinkDevice(USBDevice):
+    '''
+    Completes every bulk-OUT URB without looking at the payload
+    '''
+
+    def __init__(self):
+        self._device_descriptor = DeviceDescriptor(bDeviceClass=0, bDeviceSubClass=0, bDeviceProtocol=0,
+                                                   bMaxPacketSize0=0x40, idVendor=0x03F0, idProduct=0x1234,
+                                                   bcdDevice=0x0100, bNumConfigurations=1)
+        interface = InterfaceDescriptor(bNumEndpoints=1, bInterfaceClass=0x07, bInterfaceSubClass=0x01,
+                                        bInterfaceProtocol=0x04)
+        interface.endpoints = [EndpointDescriptor(bEndpointAddress=0x01, bmAttributes=0x02,
+                                                  wMaxPacketSize=0x40, bInterval=0)]
+        configuration = DeviceConfiguration(bNumInterfaces=1, bMaxPower=0x32)
+        configuration.interfaces = [[interface]]
+        self._configurations = [configuration]
+        super().__init__()
+
+    @property
+    def device_descriptor(self):
+        return self._device_descriptor
+
+    @property
+    def configurations(self):
+        return self._configurations
+
+    def handle_data(self, usb_req):
+        self.send_usb_ret(usb_req, b'', usb_req.transfer_buffer_length)
+
+    def handle_device_specific_control(self, control_req, usb_req):
+        self.send_usb_ret(usb_req, b'', 0, status=1)
+
+
+def bulk_out_stream(count):
+    stream = bytearray()
+    for seqnum in range(count):
+        stream += USBIP_CMD_Submit(command=0x1, seqnum=seqnum, devid=0x10002, direction=USBIP_DIR_OUT, ep=1,
+                                   transfer_flags=0, transfer_buffer_length=PAYLOAD_SIZE, start_frame=0,
+                                   number_of_packets=0, interval=0, setup=bytes(8)).pack()
+        stream += bytes(PAYLOAD_SIZE)
+    return bytes(stream)
+
+
+def drain(conn):
+    buffer = bytearray(1 << 16)
+    while conn.recv_into(buffer):
+        pass
+
+
+def stream_urbs(container, stream):
+    host, device = socket.socketpair()
+    drainer = threading.Thread(target=drain, args=(host,))
+    drainer.start()
+    feeder = threading.Thread(target=lambda: (host.sendall(stream), host.shutdown(socket.SHUT_WR)))
+    feeder.start()
+    container.serve_urbs(device)
+    feeder.join()
+    device.shutdown(socket.SHUT_WR)
+    drainer.join()
+    host.close()
+    device.close()
+
+
+def created(statistics):
+    return {'cmd_submit': statistics['cmd_submit']['created'],
+            'ret_submit': statistics['ret_submit']['created'],
+            'usb_request': statistics['usb_request']['created'],
+            'buffers': sum(pool['created'] for pool in statistics['buffers'].values())}
+
+
+def test_steady_state_urbs_reuse_pooled_records_and_buffers():
+    debug = USBIP.debug
+    USBIP.set_debug(False)
+    try:
+        container = USBContainer()
+        container.add_usb_device(SinkDevice())
+        warmup = bulk_out_stream(WARMUP_URBS)
+        measured = bulk_out_stream(MEASURED_URBS)
+        stream_urbs(container, warmup)
+
+        created_before = created(USBIP.pool_statistics())
+        tracemalloc.start()
+        try:
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            stream_urbs(container, measured)
+            after, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        created_after = created(USBIP.pool_statistics())
+    finally:
+        USBIP.set_debug(debug)
+
+    # Once warmed up, every URB runs on pooled command, request and return
+    # records and a pooled payload buffer; none are allocated per URB
+    assert created_after == created_before
+    # Nothing is retained, and the transient peak stays far below holding
+    # a copy of each payload
+    assert after - before < 64 << 10
+    assert peak - before < MEASURED_URBS * PAYLOAD_SIZE // 50
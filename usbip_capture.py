@@ -0,0 +1,306 @@
+import argparse
+import os
+import socket
+import struct
+import threading
+import time
+
+from USBIP import USBContainer
+
+
+CAPTURE_HOST_TO_DEVICE = 0
+CAPTURE_DEVICE_TO_HOST = 1
+
+CAPTURE_MAGIC = b'USBIPCAP'
+CAPTURE_VERSION = 1
+
+USBIP_CMD_SUBMIT = 0x1
+USBIP_RET_SUBMIT = 0x3
+USBIP_PDU_HEADER_SIZE = 48
+
+LINKTYPE_USB_LINUX_MMAPPED = 220
+PCAP_SNAPLEN = 0x40000
+
+# struct usbmon_packet from Documentation/usb/usbmon.rst, in host byte order
+usbmon_packet = struct.Struct('<QBBBBHBBqiiII8siiII')
+pcap_file_header = struct.Struct('<IHHiIII')
+pcap_record_header = struct.Struct('<IIII')
+usbip_pdu_header = struct.Struct('>IIIII')
+
+
+class CaptureRing:
+    '''
+    Preallocated ring of timestamped USB/IP PDUs. Once the ring is full the
+    oldest PDUs are overwritten, so capturing can stay on for long sessions.
+    Records use the same layout in memory and in the capture file.
+    '''
+
+    record_header = struct.Struct('<QBI')  # timestamp (ns), direction, length
+
+    def __init__(self, capacity=16 << 20):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.start = 0
+        self.used = 0
+        self.records = 0
+        self.dropped = 0
+
+    def wrap(self, conn):
+        return CapturingConnection(conn, self)
+
+    def record_received(self, *parts):
+        self.record(CAPTURE_HOST_TO_DEVICE, parts)
+
+    def record_sent(self, *parts):
+        self.record(CAPTURE_DEVICE_TO_HOST, parts)
+
+    def record(self, direction, parts):
+        timestamp = time.time_ns()
+        length = sum(len(part) for part in parts if part is not None)
+        needed = self.record_header.size + length
+        with self.lock:
+            if needed > self.capacity:
+                self.dropped += 1
+                return
+            while self.used + needed > self.capacity:
+                self.drop_oldest()
+            # The record only becomes part of the ring once all of it is
+            # written, so an exception part way through, e.g. Ctrl+C on the
+            # thread completing URBs, cannot leave a truncated record behind
+            position = self.write(self.record_header.pack(timestamp, direction, length),
+                                  (self.start + self.used) % self.capacity)
+            for part in parts:
+                if part is not None:
+                    position = self.write(part, position)
+            self.used, self.records = self.used + needed, self.records + 1
+
+    def write(self, data, position):
+        # Returns the position after data
+        first = min(len(data), self.capacity - position)
+        self.buffer[position:position + first] = data[:first]
+        if first < len(data):
+            self.buffer[:len(data) - first] = data[first:]
+        return (position + len(data)) % self.capacity
+
+    def read(self, offset, length):
+        position = (self.start + offset) % self.capacity
+        first = min(length, self.capacity - position)
+        data = bytes(self.buffer[position:position + first])
+        if first < length:
+            data += bytes(self.buffer[:length - first])
+        return data
+
+    def drop_oldest(self):
+        _, _, length = self.record_header.unpack(self.read(0, self.record_header.size))
+        size = self.record_header.size + length
+        self.start, self.used, self.records, self.dropped = \
+            (self.start + size) % self.capacity, self.used - size, self.records - 1, self.dropped + 1
+
+    def clear(self):
+        with self.lock:
+            self.start = 0
+            self.used = 0
+            self.records = 0
+            self.dropped = 0
+
+    def snapshot(self):
+        with self.lock:
+            return self.read(0, self.used)
+
+    def save(self, path):
+        # Written next to `path` and renamed, so a reader never sees a partial
+        # file and an interrupted save keeps the previous one
+        with self.save_lock:
+            with open(path + '.tmp', 'wb') as f:
+                f.write(CAPTURE_MAGIC + struct.pack('<I', CAPTURE_VERSION))
+                f.write(self.snapshot())
+            os.replace(path + '.tmp', path)
+
+    def save_pcap(self, path):
+        with self.save_lock:
+            write_pcap(path + '.tmp', iter_records(self.snapshot()))
+            os.replace(path + '.tmp', path)
+
+
+class CapturingConnection:
+    '''
+    Socket wrapper that records every PDU sent back to the host
+    '''
+
+    def __init__(self, conn, capture):
+        self.conn = conn
+        self.capture = capture
+
+    def sendall(self, data):
+        self.capture.record_sent(data)
+        return self.conn.sendall(data)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def iter_records(data):
+    offset = 0
+    while offset < len(data):
+        timestamp, direction, length = CaptureRing.record_header.unpack_from(data, offset)
+        offset += CaptureRing.record_header.size
+        yield timestamp, direction, data[offset:offset + length]
+        offset += length
+
+
+def load_capture(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+        raise ValueError(f"{path} is not a USB/IP capture file")
+    version, = struct.unpack_from('<I', data, len(CAPTURE_MAGIC))
+    if version != CAPTURE_VERSION:
+        raise ValueError(f"Unsupported capture version {version}")
+    return list(iter_records(data[len(CAPTURE_MAGIC) + 4:]))
+
+
+def usbmon_events(records):
+    # Turns CMD_SUBMIT/RET_SUBMIT PDUs into usbmon submit/complete events;
+    # OP_REQ/OP_REP management PDUs have no usbmon equivalent and are skipped
+    submitted = {}
+    for timestamp, direction, pdu in records:
+        if len(pdu) < USBIP_PDU_HEADER_SIZE:
+            continue
+        command, seqnum, devid, usbip_direction, ep = usbip_pdu_header.unpack_from(pdu)
+        if direction == CAPTURE_HOST_TO_DEVICE and command == USBIP_CMD_SUBMIT:
+            transfer_flags, transfer_buffer_length, start_frame, number_of_packets, interval = \
+                struct.unpack_from('>IIiIi', pdu, 20)
+            setup = pdu[40:48]
+            data = pdu[USBIP_PDU_HEADER_SIZE:]
+            submitted[seqnum] = (devid, usbip_direction, ep)
+            header = usbmon_packet.pack(seqnum, ord('S'), 2 if ep == 0 else 3,
+                                        ep | (0x80 if usbip_direction else 0),
+                                        devid & 0xff, devid >> 16,
+                                        0 if ep == 0 else ord('-'),
+                                        0 if data else ord('<'),
+                                        timestamp // 1000000000, timestamp // 1000 % 1000000,
+                                        -115,  # -EINPROGRESS
+                                        transfer_buffer_length, len(data), setup,
+                                        interval, start_frame, transfer_flags, 0)
+            yield timestamp, header + data
+        elif direction == CAPTURE_DEVICE_TO_HOST and command == USBIP_RET_SUBMIT:
+            if seqnum not in submitted:
+                continue
+            devid, usbip_direction, ep = submitted.pop(seqnum)
+            status, actual_length = struct.unpack_from('>iI', pdu, 20)
+            data = pdu[USBIP_PDU_HEADER_SIZE:]
+            header = usbmon_packet.pack(seqnum, ord('C'), 2 if ep == 0 else 3,
+                                        ep | (0x80 if usbip_direction else 0),
+                                        devid & 0xff, devid >> 16,
+                                        ord('-'), 0 if data else ord('>'),
+                                        timestamp // 1000000000, timestamp // 1000 % 1000000,
+                                        -status if status > 0 else status,
+                                        actual_length, len(data), bytes(8),
+                                        0, 0, 0, 0)
+            yield timestamp, header + data
+
+
+def write_pcap(path, records):
+    with open(path, 'wb') as f:
+        f.write(pcap_file_header.pack(0xa1b2c3d4, 2, 4, 0, 0, PCAP_SNAPLEN, LINKTYPE_USB_LINUX_MMAPPED))
+        for timestamp, packet in usbmon_events(records):
+            captured = packet[:PCAP_SNAPLEN]
+            f.write(pcap_record_header.pack(timestamp // 1000000000, timestamp // 1000 % 1000000,
+                                            len(captured), len(packet)))
+            f.write(captured)
+
+
+def replay(container, records, realtime=False):
+    '''
+    Feeds the host side of a captured session into `container` over a socket
+    pair and returns throughput statistics. With `realtime` the original
+    inter-PDU timing is kept, otherwise PDUs are sent as fast as possible.
+    '''
+    host, device = socket.socketpair()
+    received = [0]
+
+    # A capture whose ring has wrapped may start after OP_REQ_IMPORT
+    attached = False
+    for _, direction, pdu in records:
+        if direction == CAPTURE_HOST_TO_DEVICE:
+            attached = len(pdu) >= USBIP_PDU_HEADER_SIZE and usbip_pdu_header.unpack_from(pdu)[0] == USBIP_CMD_SUBMIT
+            break
+
+    def drain():
+        while 1:
+            data = host.recv(1 << 16)
+            if not data:
+                break
+            received[0] += len(data)
+
+    serve = threading.Thread(target=container.handle_connection, args=(device, attached), daemon=True)
+    drainer = threading.Thread(target=drain, daemon=True)
+    serve.start()
+    drainer.start()
+
+    pdus = 0
+    sent = 0
+    first_timestamp = None
+    started = time.perf_counter()
+    for timestamp, direction, pdu in records:
+        if direction != CAPTURE_HOST_TO_DEVICE:
+            continue
+        if realtime:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = (timestamp - first_timestamp) / 1e9 - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+        host.sendall(pdu)
+        pdus += 1
+        sent += len(pdu)
+    host.shutdown(socket.SHUT_WR)
+    serve.join()
+    device.shutdown(socket.SHUT_RDWR)
+    drainer.join()
+    elapsed = time.perf_counter() - started
+    host.close()
+    device.close()
+    return {'pdus': pdus,
+            'bytes_in': sent,
+            'bytes_out': received[0],
+            'elapsed': elapsed,
+            'pdus_per_second': pdus / elapsed if elapsed else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert or replay USB/IP session captures')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    pcap_parser = subparsers.add_parser('pcap', help='convert a capture to a usbmon pcap for Wireshark')
+    pcap_parser.add_argument('capture')
+    pcap_parser.add_argument('output')
+
+    replay_parser = subparsers.add_parser('replay', help='replay a capture against an IPP-over-USB device')
+    replay_parser.add_argument('capture')
+    replay_parser.add_argument('--config', default='ipp_usb_config.json')
+    replay_parser.add_argument('--realtime', action='store_true', help='keep the original timing')
+
+    args = parser.parse_args()
+    records = load_capture(args.capture)
+    if args.command == 'pcap':
+        write_pcap(args.output, records)
+        print(f"Wrote {args.output}")
+    else:
+        from ipp_printer import IPPOverUSBDevice
+
+        ipp_device = IPPOverUSBDevice(args.config)
+        usb_container = USBContainer()
+        usb_container.add_usb_device(ipp_device)
+        try:
+            stats = replay(usb_container, records, realtime=args.realtime)
+        finally:
+            ipp_device.disconnect_from_server()
+        print(f"Replayed {stats['pdus']} PDUs ({stats['bytes_in']} bytes in, {stats['bytes_out']} bytes out) "
+              f"in {stats['elapsed']:.3f}s, {stats['pdus_per_second']:.0f} PDUs/s")
+
+
+if __name__ == "__main__":
+    main()
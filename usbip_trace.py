@@ -0,0 +1,164 @@
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+
+
+STAGE_RECEIVED = 'received'
+STAGE_DECODED = 'decoded'
+STAGE_DISPATCHED = 'dispatched'
+STAGE_UPSTREAM_START = 'upstream_start'
+STAGE_UPSTREAM_END = 'upstream_end'
+STAGE_COMPLETED = 'completed'
+
+
+class URBTracer:
+    '''
+    Per-stage URB latency tracing plus a sampling profiler, switched on at
+    runtime for a fixed duration. While off, the only cost on the URB path is
+    a None check on usb_req.trace.
+    '''
+
+    def __init__(self, max_traces=100000):
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.traces = deque(maxlen=max_traces)
+        self.lock = threading.Lock()
+        self.profiler = None
+        self.timer = None
+        self.options = {}
+
+    def configure(self, **options):
+        # Session options used when tracing is started by a signal
+        self.options = options
+
+    def begin(self):
+        # Returns the stage list for a sampled URB, None otherwise
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        return [(STAGE_RECEIVED, time.perf_counter_ns())]
+
+    def mark(self, usb_req, stage):
+        if usb_req.trace is not None:
+            usb_req.trace.append((stage, time.perf_counter_ns()))
+
+    def finish(self, usb_req):
+        if usb_req.trace is not None:
+            self.traces.append((usb_req.ep, usb_req.trace))
+            usb_req.trace = None
+
+    def start(self, duration=30, sample_rate=1.0, profile_interval=0.005, report_dir='.'):
+        with self.lock:
+            if self.enabled:
+                return
+            self.traces.clear()
+            self.sample_rate = sample_rate
+            self.profiler = SamplingProfiler(profile_interval)
+            self.profiler.start()
+            self.enabled = True
+            self.timer = threading.Timer(duration, self.stop, args=(report_dir,))
+            self.timer.daemon = True
+            self.timer.start()
+        print(f"Tracing started for {duration}s (sample rate {sample_rate})")
+
+    def stop(self, report_dir='.'):
+        with self.lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            self.timer.cancel()
+            self.profiler.stop()
+            profiler = self.profiler
+            self.profiler = None
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        trace_path = os.path.join(report_dir, f'urb_trace_{stamp}.txt')
+        profile_path = os.path.join(report_dir, f'profile_{stamp}.folded')
+        with open(trace_path, 'w') as f:
+            f.write(self.report())
+        with open(profile_path, 'w') as f:
+            f.write(profiler.folded())
+        print(f"Tracing stopped, wrote {trace_path} and {profile_path}")
+
+    def report(self):
+        # Latency between consecutive stages, grouped by endpoint
+        latencies = defaultdict(list)
+        traces = list(self.traces)
+        for ep, trace in traces:
+            for (stage, start), (next_stage, end) in zip(trace, trace[1:]):
+                latencies[(ep, f'{stage} -> {next_stage}')].append(end - start)
+            latencies[(ep, 'total')].append(trace[-1][1] - trace[0][1])
+
+        lines = [f'{len(traces)} traced URBs',
+                 f'{"ep":>4} {"stage":<32} {"count":>8} {"mean us":>10} {"p50 us":>10} {"p99 us":>10} {"max us":>10}']
+        for (ep, stage), values in sorted(latencies.items()):
+            values.sort()
+            lines.append(f'{ep:>4x} {stage:<32} {len(values):>8} '
+                         f'{sum(values) / len(values) / 1000:>10.1f} '
+                         f'{values[len(values) // 2] / 1000:>10.1f} '
+                         f'{values[min(len(values) - 1, len(values) * 99 // 100)] / 1000:>10.1f} '
+                         f'{values[-1] / 1000:>10.1f}')
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    '''
+    Statistical profiler that samples the stacks of all threads and keeps
+    them as folded stacks, the input format of flamegraph.pl and speedscope
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own_ident = threading.get_ident()
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.stacks.items()))
+
+
+tracer = URBTracer()
+
+
+def start_on_request(start_requested):
+    while 1:
+        start_requested.wait()
+        start_requested.clear()
+        tracer.start(**tracer.options)
+
+
+def install_signal_handler(signum=signal.SIGUSR1):
+    # Sending `signum` to the process starts a tracing session configured
+    # with tracer.configure(); must be called from the main thread. The
+    # handler only sets an event, since starting a session prints and the
+    # signal may arrive while the main thread is inside print itself
+    start_requested = threading.Event()
+    signal.signal(signum, lambda received_signum, frame: start_requested.set())
+    threading.Thread(target=start_on_request, args=(start_requested,), daemon=True).start()